@@ -0,0 +1,56 @@
+import numpy as np
+from astropy.table import Table
+from halophot.halo_tools import *
+
+'''--------------------------------------------------
+halo_batch.py - does batching targets change the TV?
+
+We simulate a handful of stars with different widths,
+aperture sizes and numbers of cadences, and check that
+tv_tpf_batch reaches the same TV for each of them as
+running tv_tpf on each target on its own.
+--------------------------------------------------'''
+
+np.random.seed(42)
+
+def simulate(ncad,npix,width):
+	t = np.linspace(0,20,ncad)
+	x = 0.6*np.sin(2*np.pi*t/0.25) + 0.05*np.random.randn(ncad)
+	y = 0.4*np.cos(2*np.pi*t/0.31) + 0.05*np.random.randn(ncad)
+	f = 1e6*(1. + 1e-3*np.sin(t))
+
+	xx, yy = np.meshgrid(np.arange(npix)-npix/2.,np.arange(npix)-npix/2.)
+	sensitivity = 1-0.05*np.random.rand(npix,npix)
+
+	tpf = np.zeros((ncad,npix,npix))
+	for j in range(ncad):
+		rr2 = (xx-x[j])**2 + (yy-y[j])**2
+		psf = np.exp(-0.5*rr2/width**2)/(2*np.pi*width**2)
+		tpf[j,:,:] = np.random.poisson(f[j]*psf*sensitivity) + 10*np.random.randn(npix,npix)
+
+	ts = Table({'time':t,
+				'cadence':np.arange(ncad),
+				'x':x,
+				'y':y,
+				'quality':np.zeros(ncad,dtype='int32')})
+
+	return censor_tpf(tpf,ts,thresh=0,verbose=False)[0]
+
+'''------------------------
+Batched against one at a time
+------------------------'''
+
+pixelvectors = [simulate(ncad,npix,width) for ncad, npix, width in
+	[(600,8,1.5),(800,10,2.0),(1000,12,2.5),(700,9,1.0),(900,11,2.0),(500,8,3.0)]]
+
+weights, lcs = tv_tpf_batch(pixelvectors,verbose=False)
+
+for j, pixels in enumerate(pixelvectors):
+	objective = tv_objective(pixels)
+	w_single, lc_single = tv_tpf(pixels,analytic=True,engine='numpy',objective=objective,verbose=False)
+	tv_batch, tv_single = objective.tv(weights[j]), objective.tv(w_single)
+	print('Target %d (%d pixels): TV %.6e batched, %.6e alone' % (j,pixels.shape[0],tv_batch,tv_single))
+	assert np.abs(tv_batch-tv_single) < 0.01*tv_single
+	assert np.allclose(lcs[j],objective.lightcurve(weights[j]))
+
+print('Batched TV matches each target on its own')
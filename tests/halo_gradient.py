@@ -0,0 +1,79 @@
+import numpy as np
+from astropy.table import Table
+from autograd import value_and_grad
+from halophot.halo_tools import *
+
+'''--------------------------------------------------
+halo_gradient.py - do the optimization engines agree?
+
+We simulate a bright star with sinusoidal xy jitter,
+censor it, and check that the closed-form gradient in
+tv_objective matches autograd for first and second
+order TV, that the linear program finds the lowest
+TV of all the engines, as the global optimum should,
+that IRLS gets within 1% of it, and that without
+analytic derivatives we get the IRLS weights.
+--------------------------------------------------'''
+
+'''------------------------
+Simulate a TPF
+------------------------'''
+
+np.random.seed(42)
+ncad, npix, width = 1000, 16, 2.5
+t = np.linspace(0,20,ncad)
+x = 0.6*np.sin(2*np.pi*t/0.25) + 0.05*np.random.randn(ncad)
+y = 0.4*np.cos(2*np.pi*t/0.31) + 0.05*np.random.randn(ncad)
+f = 1e6*(1. + 1e-3*np.sin(t))
+
+xx, yy = np.meshgrid(np.arange(npix)-npix/2.,np.arange(npix)-npix/2.)
+sensitivity = 1-0.05*np.random.rand(npix,npix)
+
+tpf = np.zeros((ncad,npix,npix))
+for j in range(ncad):
+	rr2 = (xx-x[j])**2 + (yy-y[j])**2
+	psf = np.exp(-0.5*rr2/width**2)/(2*np.pi*width**2)
+	tpf[j,:,:] = np.random.poisson(f[j]*psf*sensitivity) + 10*np.random.randn(npix,npix)
+
+ts = Table({'time':t,
+			'cadence':np.arange(ncad),
+			'x':x,
+			'y':y,
+			'quality':np.zeros(ncad,dtype='int32')})
+
+pixels = censor_tpf(tpf,ts,thresh=0,verbose=False)[0]
+
+'''------------------------
+Closed-form gradient against autograd
+------------------------'''
+
+for order in [1,2]:
+	objective = tv_objective(pixels,order=order)
+	for trial in range(3):
+		weights = np.random.randn(pixels.shape[0])
+		tv_np, grad_np = objective.tv_soft_grad(weights)
+		tv_ag, grad_ag = value_and_grad(objective.tv_soft)(weights)
+		scale = np.max(np.abs(grad_ag))
+		print('Order %d: TV difference %.1e, max gradient difference %.1e (max gradient %.1e)' % (order,
+			np.abs(tv_np-tv_ag),np.max(np.abs(grad_np-grad_ag)),scale))
+		assert np.allclose(tv_np,tv_ag,rtol=1e-10,atol=0)
+		assert np.allclose(grad_np,grad_ag,rtol=0,atol=1e-10*scale)
+
+'''------------------------
+The linear program is the global optimum
+------------------------'''
+
+objective = tv_objective(pixels,order=1)
+tvs = {}
+for engine in ['autograd','numpy','mirror','irls','linprog']:
+	weights, lc = tv_tpf(pixels,order=1,analytic=True,engine=engine,objective=objective,verbose=False)
+	tvs[engine] = objective.tv(weights)
+	print('%s: TV %.6e' % (engine,tvs[engine]))
+
+assert tvs['linprog'] <= (1+1e-6)*min(tvs.values())
+assert tvs['irls'] <= 1.01*tvs['linprog']
+
+weights, lc = tv_tpf(pixels,order=1,analytic=False,objective=objective,verbose=False)
+print('analytic=False: TV %.6e' % objective.tv(weights))
+assert np.allclose(objective.tv(weights),tvs['irls'],rtol=1e-10,atol=0)
+print('All engines consistent')
@@ -0,0 +1,77 @@
+import numpy as np
+from astropy.table import Table
+from time import time as clock
+from halophot.halo_tools import *
+
+'''--------------------------------------------------
+halo_precision.py - how much do we lose by running
+the pixel matrices in single precision?
+
+We simulate a bright star with the xy variations of 
+real K2 data, censor and optimize it in float64 and 
+in float32, and compare the weights and light curves:
+the TV should agree to 1% and the light curves to 
+150 ppm rms, as quoted in the README.
+--------------------------------------------------'''
+
+fname = '../EPIC_211309989_mast.fits' # point this path to your favourite K2SC light curve
+lc = Table.read(fname)
+
+m = np.isfinite(lc['x']) & np.isfinite(lc['y'])
+x, y = lc['x'][m], lc['y'][m] # copy in the xy variations from real data 
+x, y = x - np.nanmedian(x), y - np.nanmedian(y)
+
+ncad = np.size(x)
+t = np.linspace(0,80,ncad)
+
+f = 1e7*(1. + 1e-3*np.sin(t)) # make this whatever function you like! 
+f[1000:1100] *= 0.999 # toy transit
+
+'''------------------------
+Simulate a TPF
+------------------------'''
+
+np.random.seed(42)
+npix, width = 30, 2.5
+xx, yy = np.meshgrid(np.arange(npix)-npix/2.,np.arange(npix)-npix/2.)
+sensitivity = 1-0.05*np.random.rand(npix,npix)
+
+tpf = np.zeros((ncad,npix,npix))
+for j in range(ncad):
+	rr2 = (xx-x[j])**2 + (yy-y[j])**2
+	psf = np.exp(-0.5*rr2/width**2)/(2*np.pi*width**2)
+	tpf[j,:,:] = np.random.poisson(f[j]*psf*sensitivity) + 10*np.random.randn(npix,npix)
+
+ts = Table({'time':t,
+			'cadence':np.arange(ncad),
+			'x':x,
+			'y':y,
+			'quality':np.zeros(ncad,dtype='int32')})
+
+'''------------------------
+Run in both precisions
+------------------------'''
+
+results = {}
+for dtype in ['float64','float32']:
+	start = clock()
+	pf, newts, weights, wmap, pixels = do_lc(tpf,ts,(None,None),1,1,thresh=0,
+		analytic=True,engine='numpy',dtype=dtype,verbose=False)
+	finish = clock()
+	lc_opt = newts['corr_flux']/np.nanmedian(newts['corr_flux'])
+	tv = diff_1(lc_opt)/float(ncad)
+	results[dtype] = (weights, lc_opt, tv, pixels.nbytes, finish-start)
+	print('%s: TV per point %.4e, pixel matrix %.1f MB, time %.2f s' % (dtype, 
+		tv, pixels.nbytes/1e6, finish-start))
+
+w64, lc64, tv64 = results['float64'][:3]
+w32, lc32, tv32 = results['float32'][:3]
+rms = 1e6*np.sqrt(np.nanmean((lc64-lc32)**2))
+
+print('Max weight difference: %.2e (max weight %.2e)' % (np.max(np.abs(w64-w32)),np.max(w64)))
+print('Relative TV difference: %.2e' % (np.abs(tv32-tv64)/tv64))
+print('RMS light curve difference: %.2e ppm' % rms)
+print('RMS light curve scatter: %.2e ppm' % (1e6*np.nanstd(lc64/savgol_filter(lc64,51,3))))
+
+assert np.abs(tv32-tv64) < 0.01*tv64
+assert rms < 150.
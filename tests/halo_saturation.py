@@ -0,0 +1,62 @@
+import numpy as np
+from astropy.table import Table
+from halophot.halo_tools import *
+
+'''--------------------------------------------------
+halo_saturation.py - does the grid search find the knee?
+
+We make cubes of a saturated star whose charge bleeds
+up and down the columns, with a few dead pixels, and
+check that censor_tpf cuts the same number of saturated
+pixels with search='grid' as with search='exhaustive'.
+The scatter is not monotonic in the number cut on
+these cubes, which is what used to trip up bisecting.
+--------------------------------------------------'''
+
+def saturated_cube(seed,ncad=600,npix=20,width=1.5,flux=4e6,well=7.5e4,nbad=10):
+	np.random.seed(seed)
+	t = np.linspace(0,10,ncad)
+	x = 0.5*np.sin(2*np.pi*t/0.25) + 0.05*np.random.randn(ncad)
+	y = 0.3*np.cos(2*np.pi*t/0.31) + 0.05*np.random.randn(ncad)
+	f = flux*(1. + 1e-3*np.sin(t))
+	xx, yy = np.meshgrid(np.arange(npix)-npix/2.,np.arange(npix)-npix/2.)
+	sens = 1-0.05*np.random.rand(npix,npix)
+	tpf = np.zeros((ncad,npix,npix))
+	for j in range(ncad):
+		rr2 = (xx-x[j])**2 + (yy-y[j])**2
+		img = f[j]*np.exp(-0.5*rr2/width**2)/(2*np.pi*width**2)*sens
+		for c in range(npix):
+			col = img[:,c]
+			excess = np.sum(np.maximum(col-well,0))
+			if excess > 0:
+				# spill the charge above full well into the neighbours
+				col = np.minimum(col,well)
+				r, k = np.argmax(col), 1
+				while excess > 0 and k < npix:
+					for rr in (r-k,r+k):
+						if 0 <= rr < npix and excess > 0:
+							add = min(well-col[rr],excess)
+							col[rr] += add
+							excess -= add
+					k += 1
+				img[:,c] = col
+		tpf[j] = np.random.poisson(np.maximum(img,0)) + 10*np.random.randn(npix,npix)
+	bad = np.random.choice(npix*npix,nbad,replace=False)
+	tpf[:,bad//npix,bad%npix] = np.nan
+	ts = Table({'time':t,'cadence':np.arange(ncad),'x':x,'y':y,
+				'quality':np.zeros(ncad,dtype='int32')})
+	return tpf, ts
+
+'''------------------------------------
+Same knee either way
+------------------------------------'''
+
+for seed in range(8):
+	tpf, ts = saturated_cube(seed)
+	nsat = {}
+	for search in ['exhaustive','grid']:
+		nsat[search] = censor_tpf(tpf,ts,thresh=-1,verbose=False,search=search)[-1]
+	print('Seed %d: %d saturated pixels exhaustive, %d grid' % (seed,nsat['exhaustive'],nsat['grid']))
+	assert nsat['grid'] == nsat['exhaustive']
+
+print('Grid search agrees with the exhaustive search')
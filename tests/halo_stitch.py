@@ -0,0 +1,49 @@
+import numpy as np
+from astropy.table import Table, vstack
+from astropy.time import Time
+from halophot.halo_tools import *
+
+'''--------------------------------------------------
+halo_stitch.py - does stitch join segments correctly?
+
+We make a few light curve segments and check that 
+stitch gives the same table as normalizing each one
+by its median and joining them with vstack, for plain
+columns and for a Time column as lightkurve gives us,
+and that the segments themselves are left alone.
+--------------------------------------------------'''
+
+np.random.seed(42)
+
+def segments(timecol):
+	tslist, start = [], 0.
+	for n in [300,250,400]:
+		t = start + np.arange(n)/48.
+		start = t[-1] + 1./48.
+		ts = Table({'time':Time(t+2457000.,format='jd') if timecol else t,
+					'cadence':np.arange(n),
+					'x':np.random.randn(n),
+					'y':np.random.randn(n),
+					'corr_flux':1e5*(1.+1e-3*np.random.randn(n))})
+		tslist.append(ts)
+	return tslist
+
+for timecol in [False,True]:
+	tslist = segments(timecol)
+	before = [np.copy(tsj['corr_flux']) for tsj in tslist]
+
+	newts = stitch(tslist)
+
+	expected = vstack([tsj.copy() for tsj in tslist])
+	expected['corr_flux'] = np.concatenate([tsj['corr_flux']/np.nanmedian(tsj['corr_flux']) for tsj in tslist])
+
+	assert newts.colnames == expected.colnames
+	for name in newts.colnames:
+		if timecol and name == 'time':
+			assert isinstance(newts[name],Time)
+			assert np.all(newts[name].jd == expected[name].jd)
+		else:
+			assert np.allclose(newts[name],expected[name],rtol=1e-15,atol=0)
+	for tsj, flux in zip(tslist,before):
+		assert np.all(tsj['corr_flux'] == flux)
+	print('%s time column: %d cadences stitched correctly' % ('Time' if timecol else 'Plain',len(newts)))